@@ -1,12 +1,24 @@
 import datetime
+import functools
 import json
 import os
 import shutil
+import orjson
 import pandas as pd
 import requests
 from gcloud import storage
 from google.cloud import bigquery
 from google.cloud.exceptions import NotFound
+from pathlib import Path
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Sessão HTTP reaproveitada nas requisições à API do Spotify. Ela mantém as conexões abertas entre as chamadas,
+# pede as respostas compactadas (gzip) e refaz as requisições que falharem por limite de uso (429) ou erro do servidor,
+# respeitando o header "Retry-After" enviado pela API
+_SESSION = requests.Session()
+_SESSION.headers.update({"Accept-Encoding": "gzip"})
+_SESSION.mount("https://", HTTPAdapter(max_retries=Retry(total=5, backoff_factor=0.2, status_forcelist=[429, 500, 502, 503, 504])))
 
 def read_spotify_secret(json_file_path: str) -> dict:
     """
@@ -22,6 +34,41 @@ def read_spotify_secret(json_file_path: str) -> dict:
 
     return secrets
 
+def _set_google_credentials():
+    """
+    Esta função cria uma variável de ambiente contendo o caminho para o arquivo "key_file.json" da conta de serviço,
+    que é utilizado pelos clientes das APIs do Google.
+    """
+
+    pk_path = os.getcwd()+"/secrets/key_file.json"
+    os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = pk_path
+
+@functools.lru_cache(maxsize=None)
+def _get_gcs_client() -> storage.Client:
+    """
+    Esta função retorna um cliente da API do GCS. O cliente é criado apenas na primeira chamada (depois de definir as credenciais)
+    e reaproveitado nas seguintes, já que extract, transform e load rodam no mesmo processo.
+
+    :return: Cliente da API do GCS.
+    :rtype: storage.Client
+    """
+
+    _set_google_credentials()
+    return storage.Client()
+
+@functools.lru_cache(maxsize=None)
+def _get_bq_client() -> bigquery.Client:
+    """
+    Esta função retorna um cliente da API do BigQuery, criado apenas na primeira chamada (depois de definir as credenciais)
+    e reaproveitado nas seguintes.
+
+    :return: Cliente da API do BigQuery.
+    :rtype: bigquery.Client
+    """
+
+    _set_google_credentials()
+    return bigquery.Client()
+
 def upload_object_to_bucket(bucket_name: str, object_path: str, object_key=None) -> bool:
     """
     Esta função é responsável por fazer upload de um arquivo/objeto a um determinado bucket no GCS.
@@ -35,25 +82,16 @@ def upload_object_to_bucket(bucket_name: str, object_path: str, object_key=None)
     file_name = (object_path if (object_key==None) else object_key)
         
     try:
-        # Criando uma variável de ambiente contendo o caminho para o arquivo "key_file.json" da conta de serviço
-        pk_path = os.getcwd()+"/secrets/key_file.json"
-        os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = pk_path
-
-       # Instanciando um novo cliente da API gcloud
-        client = storage.Client()
-        # Recuperando um objeto referente ao nosso Bucket
-        bucket = client.get_bucket(bucket_name)
-        if bucket==None:
-            return False
+        # Recuperando o cliente da API gcloud
+        client = _get_gcs_client()
+        # Recuperando um objeto referente ao nosso Bucket (sem requisição à API)
+        bucket = client.bucket(bucket_name)
         # Fazendo upload do objeto (arquivo) desejado
         blob = bucket.blob(file_name)
         blob.upload_from_filename(object_path)
     except Exception as e:
         print(e)
         return False
-    except FileNotFoundError as e:
-        print(e)
-        return False
         
     return True
 
@@ -90,22 +128,21 @@ def extract_spotify_data(spotify_secret_file_path='', bucket_name='') -> str:
     # Realizando a requisição:
     # O parâmetro "after" serve para indicarmos a partir de quando devemos fazer a busca
     # O parâmetro "limit" define o limite de músicas retornadas (o valor máximo é 50)
-    request = requests.get(f"https://api.spotify.com/v1/me/player/recently-played?after={yesterdays_timestamp}&limit=50", headers = headers)
+    request = _SESSION.get(f"https://api.spotify.com/v1/me/player/recently-played?after={yesterdays_timestamp}&limit=50", headers = headers)
 
     # Transformando o resultado da requisição em um objeto JSON
-    data = request.json()
+    data = orjson.loads(request.content)
 
     # Recuperando a data e hora da execução
     date = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
 
-    # Checando a existência do diretório local para armazenar o JSON
-    if not os.path.exists('spotify_data/raw/'):
-        os.makedirs('spotify_data/raw/')
+    # Criando o diretório local para armazenar o JSON (caso ainda não exista)
+    Path('spotify_data/raw/').mkdir(parents=True, exist_ok=True)
 
     # Salvando o resultado da requisição em um arquivo JSON
     file_name = f'spotify_data/raw/{date}_spotify_data.json'
-    with open(file_name, 'w+') as f:
-        json.dump(data, f, indent=4)
+    with open(file_name, 'wb') as f:
+        f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
 
     # Fazendo upload do arquivo JSON para o bucket
     object_key = f"raw/{date}_spotify_data.json"
@@ -128,12 +165,8 @@ def transform(json_object_key="") -> str:
 
     # Fazendo download do JSON do bucket, para iniciar as transformações
     try:
-        # Criando uma variável de ambiente contendo o caminho para o arquivo "key_file.json" da conta de serviço
-        pk_path = os.getcwd()+"/secrets/key_file.json"
-        os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = pk_path
-       
-        # Instanciando um novo cliente da API gcloud
-        client = storage.Client()
+        # Recuperando o cliente da API gcloud
+        client = _get_gcs_client()
 
         # Variáveis auxiliares
         full_object_key_splited = json_object_key.split('/')
@@ -141,8 +174,8 @@ def transform(json_object_key="") -> str:
         object_key = json_object_key.replace(f"{bucket_name}/", "")
         local_path = f"spotify_data//raw//{full_object_key_splited[-1]}"
        
-        # Criando um objeto para o Bucket
-        bucket = client.get_bucket(bucket_name)
+        # Criando um objeto para o Bucket (sem requisição à API)
+        bucket = client.bucket(bucket_name)
         # Criando um objeto BLOB para o caminho do arquivo
         blob = bucket.blob(object_key)
         # Fazendo download local do arquivo
@@ -152,45 +185,29 @@ def transform(json_object_key="") -> str:
         exit()
 
     # Abrindo o JSON que foi baixado
-    file = open(local_path)
-    data = json.load(file)
+    file = open(local_path, 'rb')
+    data = orjson.loads(file.read())
     file.close()
    
-    # Definindo as listas que vão armazenar as informações que desejamos.
-    # Elas irão nos auxiliar a compor o Dataframe final que vai resultar num .csv.
-    song_names = []
-    album_names = []
-    artist_names = []
-    songs_duration_ms = []
-    songs_popularity = []
-    played_at_list = []
-
-    # Percorrendo todos os itens presentes no JSON e capturando as informações que
-    # queremos armazenar no .csv final
-    for song in data["items"]:
-        song_names.append(song["track"]["name"])
-        album_names.append(song["track"]["album"]["name"])
-        artist_names.append(song["track"]["album"]["artists"][0]["name"])
-        songs_duration_ms.append(song["track"]["duration_ms"])
-        songs_popularity.append(song["track"]["popularity"])
-        played_at_list.append(song["played_at"])
-
-    # Criando um dicionário com os resultados obtidos nas listas
-    song_dict = {
-        "song_name": song_names,
-        "album_name": album_names,
-        "artist_name": artist_names,
-        "duration_ms": songs_duration_ms,
-        "popularity": songs_popularity,
-        "played_at": played_at_list
-    }
+    # Percorrendo todos os itens presentes no JSON e capturando, em uma única passada,
+    # as informações que queremos armazenar no .csv final
+    rows = [
+        (
+            song["track"]["name"],
+            song["track"]["album"]["name"],
+            song["track"]["album"]["artists"][0]["name"],
+            song["track"]["duration_ms"],
+            song["track"]["popularity"],
+            song["played_at"]
+        )
+        for song in data["items"]
+    ]
 
-    # Transformando nosso dicionário em um dataframe
-    song_df = pd.DataFrame(song_dict, columns=["song_name", "album_name", "artist_name", "duration_ms", "popularity", "played_at"])
+    # Transformando as informações capturadas em um dataframe
+    song_df = pd.DataFrame(rows, columns=["song_name", "album_name", "artist_name", "duration_ms", "popularity", "played_at"])
    
-    # Checando a existência do diretório local para armazenar o .csv
-    if not os.path.exists('spotify_data/transformed/'):
-        os.makedirs('spotify_data/transformed/')
+    # Criando o diretório local para armazenar o .csv (caso ainda não exista)
+    Path('spotify_data/transformed/').mkdir(parents=True, exist_ok=True)
    
     # Convertendo nosso dataframe para um .csv
     file_name = ((full_object_key_splited[-1]).rsplit('.',1)[0])+'.csv'
@@ -219,12 +236,8 @@ def load(csv_object_key="") -> bool:
     :return: True se a inserção tiver ocorrido com sucesso. False caso contrário.
     :rtype: bool
     """
-    # Criando uma variável de ambiente contendo o caminho para o arquivo "key_file.json" da conta de serviço
-    pk_path = os.getcwd()+"/secrets/key_file.json"
-    os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = pk_path
-
-    # Instanciando um novo cliente da API gcloud
-    client = bigquery.Client()
+    # Recuperando o cliente da API gcloud
+    client = _get_bq_client()
 
    # Checa se o dataset existe. Se não existe, cria um novo dataset
     dataset_id = "Spotify_Data"
@@ -267,9 +280,7 @@ def load(csv_object_key="") -> bool:
         # Capturando o número de registros na tabela antes de iniciar o load
         query_count = f"SELECT COUNT(*) FROM {table_id}"
         query_count_job = client.query(query_count)
-        start_count = 0
-        for row in query_count_job:
-            start_count=start_count+row[0]
+        start_count = next(iter(query_count_job.result()))[0]
 
         # Definimos a URI do nosso objeto .csv transformado dentro do bucket
         uri = f"gs://{csv_object_key}"
@@ -290,9 +301,7 @@ def load(csv_object_key="") -> bool:
         # Capturando o número de registros na tabela depois de realizar o load
         query_count = f"SELECT COUNT(*) FROM {table_id}"
         query_count_job = client.query(query_count)
-        end_count = 0
-        for row in query_count_job:
-            end_count=end_count+row[0]  
+        end_count = next(iter(query_count_job.result()))[0]
 
         print(f"{end_count-start_count} novos registros em {table_id}!")
     except Exception as e:
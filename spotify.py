@@ -1,17 +1,23 @@
 import datetime
-import json
-import os
-import shutil
+import functools
+import io
+import re
+import threading
+import uuid
 import airflow
-import gcloud
-import pandas as pd
+import ijson
+import pyarrow as pa
+import pyarrow.parquet as pq
 import requests
 from airflow.models import Variable
 from airflow.operators.dummy_operator import DummyOperator
 from airflow.operators.python_operator import PythonOperator
-from gcloud import storage
+from cachetools import TTLCache, cached
 from google.cloud import bigquery
+from google.cloud import storage
 from google.cloud.exceptions import NotFound
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 YESTERDAY = datetime.datetime.now() - datetime.timedelta(days=1)
 CRONTAB = "0 0 * * *" # Isso significa que será executada todos os dias à meia noite. (Você pode alterar isso, caso deseje!)
@@ -22,6 +28,43 @@ spotify_etl_config = Variable.get("spotify_etl_dag_vars", deserialize_json=True)
 SPOTIFY_SECRET = spotify_etl_config["spotify_secret"]
 BUCKET = 'poc_etl' # O nome do bucket que utilizamos para armazenar os arquivos com os dados das músicas.
 
+# Sessão HTTP reaproveitada nas requisições à API do Spotify. Ela mantém as conexões abertas entre as chamadas,
+# pede as respostas compactadas (gzip) e refaz as requisições que falharem por limite de uso (429) ou erro do servidor,
+# respeitando o header "Retry-After" enviado pela API
+_SESSION = requests.Session()
+_SESSION.headers.update({"Accept-Encoding": "gzip"})
+_SESSION.mount("https://", HTTPAdapter(max_retries=Retry(total=5, backoff_factor=0.2, status_forcelist=[429, 500, 502, 503, 504])))
+# Respostas da API do Spotify ficam em cache por 60 segundos. Chamadas com o mesmo token feitas ao mesmo tempo, no mesmo processo,
+# esperam a primeira requisição terminar e compartilham a resposta dela (cada task do Airflow roda em um processo novo,
+# então o cache não é compartilhado entre tasks nem entre execuções da DAG)
+SPOTIFY_CACHE_SIZE = 64
+SPOTIFY_CACHE_TTL = 60 # segundos
+
+# Configuração do Job que carrega as músicas transformadas na tabela de staging do BigQuery.
+# Como ela é a mesma em todas as execuções, é montada uma única vez
+_LOAD_JOB_CONFIG = bigquery.LoadJobConfig(
+    # Definições do nosso schema (estrutura da tabela)
+    schema=[
+        bigquery.SchemaField("song_name", "STRING"),
+        bigquery.SchemaField("album_name", "STRING"),
+        bigquery.SchemaField("artist_name", "STRING"),
+        bigquery.SchemaField("duration_ms", "INTEGER"),
+        bigquery.SchemaField("popularity", "INTEGER"),
+        bigquery.SchemaField("played_at", "TIMESTAMP")
+    ],
+    # Aqui definimos o formato do arquivo fonte (o nosso é um .parquet)
+    source_format=bigquery.SourceFormat.PARQUET,
+    # A tabela de staging é exclusiva de cada execução, e deve conter apenas os dados deste load
+    write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
+)
+# Query que insere na tabela final apenas as músicas da tabela de staging que ainda não estão nela.
+# O horário de reprodução (played_at) identifica unicamente cada registro, então não é necessário
+# reescrever a tabela inteira para remover duplicatas
+MERGE_QUERY = ( "MERGE `{table_id}` T"
+                " USING `{staging_table_id}` S"
+                " ON T.played_at = S.played_at"
+                " WHEN NOT MATCHED THEN INSERT ROW")
+
 default_args = {
     'owner': 'Willian de Vargas', # Coloque seu nome
     'start_date': YESTERDAY,
@@ -29,173 +72,153 @@ default_args = {
 
 # Definição de todas as funções que vamos utilizar (teremos pequenas modificações em relação às funções utilizadas na primeira etapa deste tutorial, por isso não vamos realizar a importação delas. Mas poderiamos apenas importar elas de um arquivo externo, se quisessemos)
 
-def upload_object_to_bucket(bucket_name: str, object_path: str, object_key=None) -> bool:
+@functools.lru_cache(maxsize=None)
+def _get_gcs_client() -> storage.Client:
     """
-    Esta função é responsável por fazer upload de um arquivo/objeto a um determinado bucket no GCS.
-    :param str bucket_name: Nome do bucket que receberá o arquivo/objeto.
-    :param str object_path: Caminho local para o arquivo/objeto que será enviado ao bucket.
-    :param str object_key: O caminho final do objeto dentro do bucket. Este parametro é opcional e caso não seja informado o valor do parametro object_path será assumido.
-    :returns: True se o upload for bem sucedido. False caso contrário.
-    :rtype: bool
+    Esta função retorna um cliente da API do GCS. O cliente é criado apenas na primeira chamada e reaproveitado nas seguintes,
+    evitando repetir a busca por credenciais e a abertura de novas conexões a cada upload/download.
+    :returns: Cliente da API do GCS.
+    :rtype: storage.Client
     """
 
-    file_name = (object_path if (object_key==None) else object_key)
-        
-    try:
-        # Instanciando um novo cliente da API gcloud
-        client = storage.Client()
-        # Recuperando um objeto referente ao nosso Bucket
-        bucket = client.get_bucket(bucket_name)
-        if bucket==None:
-            return False
-        # Fazendo upload do objeto (arquivo) desejado
-        blob = bucket.blob(file_name)
-        blob.upload_from_filename(object_path)
-    except Exception as e:
-        print(e)
-        return False
-    except FileNotFoundError as e:
-        print(e)
-        return False
-        
-    return True
+    return storage.Client()
+
+@functools.lru_cache(maxsize=None)
+def _get_bq_client() -> bigquery.Client:
+    """
+    Esta função retorna um cliente da API do BigQuery, criado apenas na primeira chamada e reaproveitado nas seguintes.
+    :returns: Cliente da API do BigQuery.
+    :rtype: bigquery.Client
+    """
+
+    return bigquery.Client()
+
+@cached(cache=TTLCache(maxsize=SPOTIFY_CACHE_SIZE, ttl=SPOTIFY_CACHE_TTL), condition=threading.Condition())
+def _get_recently_played(token: str, after: int) -> bytes:
+    """
+    Esta função faz a requisição das músicas reproduzidas recentemente à API do Spotify. As respostas ficam em cache por
+    SPOTIFY_CACHE_TTL segundos, e chamadas com o mesmo token e o mesmo "after" dentro dessa janela compartilham uma única requisição
+    (inclusive as concorrentes, que aguardam a requisição em andamento em vez de disparar outra).
+    :param str token: Token de acesso à API do Spotify.
+    :param int after: Unix Timestamp (em milissegundos) a partir do qual as músicas devem ser buscadas.
+    :returns: O corpo da resposta da API (JSON).
+    :rtype: bytes
+    """
 
-def extract_spotify_data(bucket_name='') -> str:
-    
     # Definindo os headers para a requisição à API
     headers = {
         "Accept": "application/json",
         "Content-Type": "application/json",
-        "Authorization": f"Bearer {SPOTIFY_SECRET}"
+        "Authorization": f"Bearer {token}"
     }
 
+    # Realizando a requisição: 
+    # O parâmetro "after" serve para indicarmos a partir de quando devemos fazer a busca
+    # O parâmetro "limit" define o limite de músicas retornadas (o valor máximo é 50)
+    request = _SESSION.get(f"https://api.spotify.com/v1/me/player/recently-played?after={after}&limit=50", headers = headers)
+    # Lançando uma exceção em caso de erro, para que respostas inválidas não fiquem no cache
+    request.raise_for_status()
+
+    return request.content
+
+def extract_spotify_data(bucket_name='') -> str:
+
     # Definindo um limite de 24 horas antes do momento que a função for executada
     # Com isso, conseguimos recuperar as últimas 50 músicas reproduzidas nas últimas  24 horas
     today = datetime.datetime.now()
     yesterday = today - datetime.timedelta(days=1) # Ontem = Hoje - 1 Dia
     # Convertendo a data para o formato Unix Timestamp, que é o formato utilizado pela API
-    yesterdays_timestamp = int(yesterday.timestamp())*1000
-
-    # Realizando a requisição: 
-    # O parâmetro "after" serve para indicarmos a partir de quando devemos fazer a busca
-    # O parâmetro "limit" define o limite de músicas retornadas (o valor máximo é 50)
-    request = requests.get(f"https://api.spotify.com/v1/me/player/recently-played?after={yesterdays_timestamp}&limit=50", headers = headers)
+    # O horário é arredondado para o início do minuto, para que chamadas próximas reaproveitem a mesma resposta do cache
+    yesterdays_timestamp = (int(yesterday.timestamp()) // 60 * 60)*1000
 
-    # Transformando o resultado da requisição em um objeto JSON
-    data = request.json()
+    # Recuperando as músicas reproduzidas recentemente
+    content = _get_recently_played(SPOTIFY_SECRET, yesterdays_timestamp)
 
     # Recuperando a data e hora da execução
     date = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
 
-    # Checando a existência do diretório local para armazenar o JSON
-    if not os.path.exists('/home/airflow/spotify_data/raw/'):
-        os.makedirs('/home/airflow/spotify_data/raw/')
-
-    # Salvando o resultado da requisição em um arquivo JSON 
-    file_name = f'/home/airflow/spotify_data/raw/{date}_spotify_data.json'
-    with open(file_name, 'w+') as f:
-        json.dump(data, f, indent=4)
-
-    # Fazendo upload do arquivo JSON para o bucket
+    # Fazendo upload do resultado da requisição para o bucket.
+    # O corpo da resposta já é o próprio JSON, então não precisamos convertê-lo nem salvá-lo localmente antes
     object_key = f"raw/{date}_spotify_data.json"
-    upload_object_to_bucket(bucket_name=bucket_name, object_path=file_name, object_key=object_key)
+    client = _get_gcs_client()
+    bucket = client.bucket(bucket_name)
+    bucket.blob(object_key).upload_from_string(content, content_type="application/json")
 
     # Retorna o object key do objeto gerado (JSON com as músicas) dentro do bucket
     full_object_key = f"{bucket_name}/{object_key}"
     return full_object_key
 
-def transform(ds, **kwargs) -> str:
-    # Recuperando o retorno da função anterior
-    ti = kwargs['ti']
-    json_object_key = ti.xcom_pull(task_ids='extract_data_from_spotify_api')
+def transform(json_object_key: str) -> pa.Table:
+    """
+    Esta função é responsável pela transformação do JSON gerado pela função extract_spotify_data() em uma tabela contendo apenas as informações desejadas.
+    :param str json_object_key: Caminho para o objeto JSON dentro do bucket.
+    :returns: Tabela (pyarrow) com as músicas reproduzidas.
+    :rtype: pa.Table
+    """
 
-    # Fazendo download do JSON do bucket, para iniciar as transformações
+    # Lendo o JSON diretamente do bucket, para iniciar as transformações
     try:
-        # Instanciando um novo cliente da API gcloud
-        client = storage.Client()
+        # Recuperando o cliente da API gcloud
+        client = _get_gcs_client()
 
         # Variáveis auxiliares
         full_object_key_splited = json_object_key.split('/')
         bucket_name = full_object_key_splited[0]
         object_key = json_object_key.replace(f"{bucket_name}/", "")
-        local_path = f"/home/airflow/spotify_data/raw/{full_object_key_splited[-1]}"
-        
-        print(f"LOCAL PATH: {local_path}")
 
-        # Criando um objeto para o Bucket
-        bucket = client.get_bucket(bucket_name)
+        # Criando um objeto para o Bucket (sem requisição à API)
+        bucket = client.bucket(bucket_name)
         # Criando um objeto BLOB para o caminho do arquivo
         blob = bucket.blob(object_key)
-        # Fazendo download local do arquivo
-        blob.download_to_filename(local_path)
     except Exception as e:
         print(e)
         exit()
 
-    # Abrindo o JSON que foi baixado
-    file = open(local_path)
-    data = json.load(file)
-    file.close()
-    
-    # Definindo as listas que vão armazenar as informações que desejamos. 
-    # Elas irão nos auxiliar a compor o Dataframe final que vai resultar num .csv.
-    song_names = []
-    album_names = []
-    artist_names = []
-    songs_duration_ms = []
-    songs_popularity = []
-    played_at_list = []
-
-    # Percorrendo todos os itens presentes no JSON e capturando as informações que
-    # queremos armazenar no .csv final
-    for song in data["items"]:
-        song_names.append(song["track"]["name"])
-        album_names.append(song["track"]["album"]["name"])
-        artist_names.append(song["track"]["album"]["artists"][0]["name"])
-        songs_duration_ms.append(song["track"]["duration_ms"])
-        songs_popularity.append(song["track"]["popularity"])
-        played_at_list.append(song["played_at"])
-
-    # Criando um dicionário com os resultados obtidos nas listas
-    song_dict = {
-        "song_name": song_names,
-        "album_name": album_names,
-        "artist_name": artist_names,
-        "duration_ms": songs_duration_ms,
-        "popularity": songs_popularity,
-        "played_at": played_at_list
-    }
-
-    # Transformando nosso dicionário em um dataframe
-    song_df = pd.DataFrame(song_dict, columns=["song_name", "album_name", "artist_name", "duration_ms", "popularity", "played_at"])
-    
-    # Checando a existência do diretório local para armazenar o .csv
-    if not os.path.exists('/home/airflow/spotify_data/transformed/'):
-        os.makedirs('/home/airflow/spotify_data/transformed/')
-
-    # Convertendo nosso dataframe para um .csv
-    file_name = ((full_object_key_splited[-1]).rsplit('.',1)[0])+'.csv'
-    local_path = f"/home/airflow/spotify_data/transformed/{file_name}"
-    song_df.to_csv(local_path, index=False)
-
-    # Fazendo upload do arquivo JSON para o bucket
-    object_key = f"transformed/{file_name}"
-    upload_object_to_bucket(bucket_name=bucket_name, object_path=local_path, object_key=object_key)
-    
-    # Removendo os arquivos locais gerados
-    shutil.rmtree("/home/airflow/spotify_data/")
-
-    # Retorna o object key do objeto gerado (JSON com as músicas) dentro do bucket
-    full_object_key = f"{bucket_name}/{object_key}"
-    return full_object_key
-
-def load(ds, **kwargs) -> bool:
-    # Recuperando o retorno da função anterior
-    ti = kwargs['ti']
-    csv_object_key = ti.xcom_pull(task_ids='transform_data')
+    # Lendo os itens do JSON diretamente do bucket (sem baixar o arquivo nem carregar
+    # o documento inteiro em memória) e capturando, em uma única passada, as informações que desejamos de cada música
+    with blob.open("rb") as fp:
+        rows = [
+            (
+                song["track"]["name"],
+                song["track"]["album"]["name"],
+                song["track"]["album"]["artists"][0]["name"],
+                song["track"]["duration_ms"],
+                song["track"]["popularity"],
+                song["played_at"]
+            )
+            for song in ijson.items(fp, "items.item")
+        ]
+
+    # Separando as informações de cada música em colunas
+    song_names, album_names, artist_names, songs_duration_ms, songs_popularity, played_at_list = zip(*rows) if rows else ((),) * 6
+
+    # Montando uma tabela do pyarrow com as informações que desejamos, sem passar por um dataframe do pandas
+    song_table = pa.table({
+        "song_name": pa.array(song_names, pa.string()),
+        # Artistas e álbuns se repetem bastante entre as músicas ouvidas, então essas colunas são dictionary encoded
+        # (cada valor distinto é guardado uma única vez, inclusive no .parquet)
+        "album_name": pa.array(album_names, pa.string()).dictionary_encode(),
+        "artist_name": pa.array(artist_names, pa.string()).dictionary_encode(),
+        "duration_ms": pa.array(songs_duration_ms, pa.int64()),
+        "popularity": pa.array(songs_popularity, pa.int64()),
+        # Convertendo o horário de reprodução para timestamp (em microssegundos, que é a maior precisão aceita
+        # pelo BigQuery), para que a coluna já chegue tipada no BigQuery
+        "played_at": pa.array(played_at_list, pa.string()).cast(pa.timestamp("us", tz="UTC"))
+    })
+
+    return song_table
+
+def load(song_table: pa.Table, run_id: str) -> bool:
+    """
+    Esta função é responsável por inserir as músicas transformadas pela função transform() em uma tabela no BigQuery.
+    :param pa.Table song_table: Tabela (pyarrow) com as músicas reproduzidas.
+    :param str run_id: Identificador da execução da DAG, utilizado no nome da tabela de staging.
+    :returns: True se a inserção tiver ocorrido com sucesso. False caso contrário.
+    :rtype: bool
+    """
 
-    # Instanciando um novo cliente da API gcloud
-    client = bigquery.Client()
+    # Recuperando o cliente da API gcloud
+    client = _get_bq_client()
 
     # Checa se o dataset existe. Se não existe, cria um novo dataset
     dataset_id = "Spotify_Data"
@@ -216,63 +239,56 @@ def load(ds, **kwargs) -> bool:
         # Definindo nova tabela
         table_id = f"{client.project}.{dataset_id}.recently_played"
 
-        destination_table = client.get_table(table_id)
-        
-        # Definindo a configuração do Job
-        job_config = bigquery.LoadJobConfig(
-            # Definições do nosso schema (estrutura da tabela)
-            schema=[
-                bigquery.SchemaField("song_name", "STRING"),
-                bigquery.SchemaField("album_name", "STRING"),
-                bigquery.SchemaField("artist_name", "STRING"),
-                bigquery.SchemaField("duration_ms", "INTEGER"),
-                bigquery.SchemaField("popularity", "INTEGER"),
-                bigquery.SchemaField("played_at", "TIMESTAMP")
-            ],
-            # Aqui definimos o número de linhas que queremos pular.
-            # Como a primeira linha do nosso csv contém o nome das colunas, queremos pular sempre 1 linha
-            skip_leading_rows = 1,
-            # Aqui definimos o formato do arquivo fonte (o nosso é um .csv)
-            source_format=bigquery.SourceFormat.CSV,
-        )
-
-        # Capturando o número de registros na tabela antes de iniciar o load
-        query_count = f"SELECT COUNT(*) FROM {table_id}"
-        query_count_job = client.query(query_count)
-        start_count = 0
-        for row in query_count_job:
-            start_count=start_count+row[0]
-
-        # Definimos a URI do nosso objeto .csv transformado dentro do bucket
-        print(f"OBJECT KEY: {csv_object_key}")
-        uri = f"gs://{csv_object_key}"
-
-        # Iniciamos o job que vai carregar os dados para dentro da nossa tabela no BigQuery
-        load_job = client.load_table_from_uri(
-            uri, table_id, job_config=job_config
+        # Os dados são carregados primeiro em uma tabela de staging (uma por execução),
+        # para que apenas as músicas novas sejam comparadas com a tabela final
+        # O nome leva o run_id (apenas com caracteres aceitos pelo BigQuery) e um sufixo aleatório, para que execuções
+        # simultâneas (ex: um trigger manual no mesmo dia) nunca compartilhem, sobrescrevam ou apaguem a mesma tabela
+        staging_suffix = re.sub(r"[^0-9A-Za-z_]", "_", run_id)
+        staging_table_id = f"{table_id}_stg_{staging_suffix}_{uuid.uuid4().hex[:8]}"
+
+        # Convertendo nossa tabela para um .parquet em memória, que será enviado diretamente ao BigQuery
+        # (sem passar pelo disco local nem pelo bucket)
+        parquet_buffer = io.BytesIO()
+        pq.write_table(
+            song_table,
+            parquet_buffer,
+            compression="snappy",
+            use_dictionary=["song_name", "album_name", "artist_name"]
         )
 
-        load_job.result()
-
-        # Removendo duplicatas
-        remove_duplicates_query = ( f"CREATE OR REPLACE TABLE {table_id}"
-                                    f" AS (SELECT DISTINCT * FROM {table_id})")
-        remove_duplicates_job = client.query(remove_duplicates_query)
-        remove_duplicates_job.result()
-        # Capturando o número de registros na tabela depois de realizar o load
-        query_count = f"SELECT COUNT(*) FROM {table_id}"
-        query_count_job = client.query(query_count)
-        end_count = 0
-        for row in query_count_job:
-            end_count=end_count+row[0]   
-
-        print(f"{end_count-start_count} novos registros em {table_id}!")
+        try:
+            # Iniciamos o job que vai carregar os dados para dentro da tabela de staging no BigQuery
+            load_job = client.load_table_from_file(
+                parquet_buffer, staging_table_id, job_config=_LOAD_JOB_CONFIG, rewind=True
+            )
+
+            load_job.result()
+            print(f"{load_job.output_rows} registros carregados em {staging_table_id}!")
+
+            # Inserindo na tabela final apenas as músicas que ainda não estão nela
+            merge_job = client.query(MERGE_QUERY.format(table_id=table_id, staging_table_id=staging_table_id))
+            merge_job.result()
+
+            print(f"{merge_job.num_dml_affected_rows} novos registros em {table_id}!")
+        finally:
+            # Removendo a tabela de staging
+            client.delete_table(staging_table_id, not_found_ok=True)
     except Exception as e:
         print(e)
         return False
     
     return True
 
+def transform_and_load(ds, **kwargs) -> bool:
+    # Recuperando o retorno da função anterior
+    ti = kwargs['ti']
+    json_object_key = ti.xcom_pull(task_ids='extract_data_from_spotify_api')
+
+    # A transformação e o load são feitos na mesma task, para que a tabela transformada
+    # seja enviada ao BigQuery direto da memória, sem precisar ser salva no bucket
+    song_table = transform(json_object_key)
+    return load(song_table, kwargs['run_id'])
+
 # Definição da DAG (vamos definir a execução desta dag)
 
 with airflow.DAG('spotify_etl_dag', schedule_interval=CRONTAB, tags=TAGS_LIST, default_args=default_args, catchup=False) as dag:
@@ -287,14 +303,9 @@ with airflow.DAG('spotify_etl_dag', schedule_interval=CRONTAB, tags=TAGS_LIST, d
         op_kwargs={"bucket_name":BUCKET}
     )
 
-    transformation = PythonOperator(
-        task_id = 'transform_data',
-        python_callable = transform,
-    )
-
-    load_data_into_bq = PythonOperator(
-        task_id = 'load_data_into_bigquery',
-        python_callable = load,
+    transformation_and_load = PythonOperator(
+        task_id = 'transform_and_load_data_into_bigquery',
+        python_callable = transform_and_load,
     )
 
     end = DummyOperator(
@@ -303,4 +314,4 @@ with airflow.DAG('spotify_etl_dag', schedule_interval=CRONTAB, tags=TAGS_LIST, d
     )
 
     # Declaring dependences between tasks
-    begin >> extraction >> transformation >> load_data_into_bq >> end
\ No newline at end of file
+    begin >> extraction >> transformation_and_load >> end
\ No newline at end of file